@@ -1,15 +1,60 @@
+import re
+import threading
 import streamlit as st
 import yfinance as yf
 import pandas as pd
+import numpy as np
 import plotly.express as px
+from matplotlib import colormaps
+from matplotlib.colors import Normalize
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # --- 1. 網頁設定與狀態初始化 ---
 st.set_page_config(page_title="存股族福音!計算每月幫自己加薪多少", page_icon="📅", layout="wide")
 
-# 初始化 Session State 來儲存股票清單
+# 初始化 Session State 來儲存股票清單 (以欄為單位儲存：代碼、實際股數)
 if 'portfolio' not in st.session_state:
-    st.session_state.portfolio = []
+    st.session_state.portfolio = {'symbol': [], 'shares': []}
+# 與清單同步的代碼集合，用於 O(1) 檢查是否重複
+if 'portfolio_symbols' not in st.session_state:
+    st.session_state.portfolio_symbols = set(st.session_state.portfolio['symbol'])
+# 清單編輯器的版本號，每次同步後遞增以重設 data_editor 的編輯狀態
+if 'editor_version' not in st.session_state:
+    st.session_state.editor_version = 0
+
+
+# 台股代碼：4~6 位數字，可能帶一個英文字母結尾 (如 2330、0050、00679B)
+_TW_RE = re.compile(r'^\d{4,6}[A-Z]?$')
+
+
+def normalize_ticker(raw_ticker):
+    # 清理使用者輸入的代碼
+    ticker_clean = raw_ticker.strip().upper()
+    
+    # 判斷是否為台股 (未指定交易所後綴時預設為上市 .TW)
+    if "." not in ticker_clean and _TW_RE.match(ticker_clean):
+        return f"{ticker_clean}.TW"
+    return ticker_clean
+
+
+def _portfolio_view(symbols, shares):
+    # 側邊欄顯示用的清單表格，存在 session_state 中 (每個 session 只留最新一份)；
+    # 以代碼與股數的 tuple 為 key，清單沒變時直接沿用，變動時才重建
+    key = (symbols, shares)
+    cached = st.session_state.get('portfolio_view')
+    if cached is None or cached[0] != key:
+        cached = (key, pd.DataFrame({
+            '代碼': list(symbols),
+            '仟股': [s / 1000 for s in shares],  # 轉換為仟股
+        }))
+        st.session_state.portfolio_view = cached
+    return cached[1]
+
+
+# 側邊欄清單編輯器中是否有尚未套用到 session_state 的修改
+editor_pending = False
 
 # --- 2. 側邊欄：新增股票與輸入參數 ---
 with st.sidebar:
@@ -32,127 +77,279 @@ with st.sidebar:
     col1, col2 = st.columns(2)
     
     if col1.button("加入清單", type="primary"):
-        # 步驟 1: 清理並準備代碼
-        ticker_clean = input_ticker.strip().upper()
-        
-        # 步驟 2: 建立最終的搜尋代碼 (Search Symbol)
-        search_symbol = ticker_clean
+        # 步驟 1: 清理代碼並建立最終的搜尋代碼 (Search Symbol)
+        search_symbol = normalize_ticker(input_ticker)
         
-        # 判斷是否為台股
-        if "." not in search_symbol and search_symbol.isalnum():
-            search_symbol = f"{search_symbol}.TW"
-        
-        # 步驟 3: 檢查是否重複，並加入清單
-        if any(d['symbol'] == search_symbol for d in st.session_state.portfolio):
+        # 步驟 2: 檢查是否重複，並加入清單
+        if search_symbol in st.session_state.portfolio_symbols:
             st.warning(f"{search_symbol} 已經在清單中囉！")
         else:
-            st.session_state.portfolio.append({
-                "symbol": search_symbol,
-                "shares": actual_shares  # 儲存實際股數
-            })
+            st.session_state.portfolio['symbol'].append(search_symbol)
+            st.session_state.portfolio['shares'].append(actual_shares)  # 儲存實際股數
+            st.session_state.portfolio_symbols.add(search_symbol)
             st.success(f"已新增 {search_symbol} ({actual_shares:,.0f} 股)")
 
     if col2.button("清空全部"):
-        st.session_state.portfolio = []
+        st.session_state.portfolio = {'symbol': [], 'shares': []}
+        st.session_state.portfolio_symbols.clear()
         st.rerun()
 
     # --- 顯示與移除功能 ---
     st.divider()
-    st.subheader(f"目前追蹤 ({len(st.session_state.portfolio)})")
+    st.subheader(f"目前追蹤 ({len(st.session_state.portfolio['symbol'])})")
     
-    if st.session_state.portfolio:
+    if st.session_state.portfolio['symbol']:
         
-        # 建立表頭
-        col_sym_header, col_shares_header, col_del_header = st.columns([0.45, 0.35, 0.20])
-        col_sym_header.markdown("**代碼**")
-        col_shares_header.markdown("**仟股**")
-        col_del_header.markdown("**移除**")
+        portfolio = st.session_state.portfolio
+        portfolio_df = _portfolio_view(tuple(portfolio['symbol']), tuple(portfolio['shares']))
         
-        st.markdown("---")
+        # 以單一 data_editor 呈現清單，可直接修改仟股、新增或刪除列
+        edited_df = st.data_editor(
+            portfolio_df,
+            num_rows='dynamic',
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                '代碼': st.column_config.TextColumn('代碼'),
+                '仟股': st.column_config.NumberColumn('仟股', min_value=0.001, step=0.001, format='%.3f', default=1.0),
+            },
+            key=f"port_editor_{st.session_state.editor_version}",
+        )
         
-        # 迭代清單，為每檔股票添加移除按鈕
-        for i, item in enumerate(st.session_state.portfolio):
-            symbol = item['symbol']
-            shares_k = item['shares'] / 1000 # 轉換為仟股
-            
-            # 使用 columns 對齊代碼、仟股數和按鈕
-            col_sym, col_shares, col_del = st.columns([0.45, 0.35, 0.20])
-
-            col_sym.write(symbol)
-            col_shares.write(f"{shares_k:,.3f}") # 格式化為小數點後三位
-
-            # 移除按鈕 (必須使用唯一的 key)
-            if col_del.button("❌", key=f"remove_{symbol}_{i}"):
-                # 刪除該索引位置的項目
-                del st.session_state.portfolio[i]
-                st.rerun() # 重新執行腳本以更新顯示
+        # 有變更時同步回 session_state，並換一個 editor key 讓編輯紀錄歸零
+        # 仍有未填完的列 (缺代碼或仟股) 或重複代碼時先不同步，並提示修改尚未套用
+        if not edited_df.equals(portfolio_df):
+            rows = list(zip(edited_df['代碼'], edited_df['仟股']))
+            complete = all(
+                isinstance(raw_symbol, str) and raw_symbol.strip() and not pd.isna(shares_k)
+                for raw_symbol, shares_k in rows
+            )
+            
+            if not complete:
+                editor_pending = True
+                st.info("有尚未填完的列 (需填入代碼與仟股)，完成後才會套用清單的修改。")
+            else:
+                symbols, shares_list = [], []
+                seen, duplicates = set(), []
+                for raw_symbol, shares_k in rows:
+                    symbol = normalize_ticker(raw_symbol)
+                    if symbol in seen:
+                        duplicates.append(symbol)
+                        continue
+                    seen.add(symbol)
+                    symbols.append(symbol)
+                    shares_list.append(shares_k * 1000)
+                
+                if duplicates:
+                    editor_pending = True
+                    st.warning(f"{', '.join(duplicates)} 已經在清單中囉！修正後才會套用清單的修改。")
+                else:
+                    st.session_state.portfolio = {'symbol': symbols, 'shares': shares_list}
+                    st.session_state.portfolio_symbols = seen
+                    st.session_state.editor_version += 1
+                    st.rerun()
     else:
         st.info("目前清單為空")
 # --- 側邊欄結束 ---
 
 
 # --- 3. 核心邏輯：計算多檔股票 ---
-def calculate_portfolio_dividends(portfolio_list):
-    all_payouts = []
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def fetch_dividends(symbol: str, as_of: str) -> pd.Series:
+    # as_of (YYYY-MM-DD) 只用來當快取 key，讓快取每天自動換新
+    # 股數不放進這裡，調整股數不會讓網路快取失效
+    return yf.Ticker(symbol).dividends
+
+
+def fetch_dividends_batch(symbols: tuple, start: str) -> dict:
+    # 以一次 yf.download 批次下載多檔股票自 start (YYYY-MM-DD) 起的配息 (actions=True)
+    # ignore_tz=False 保留時區，與 Ticker.dividends 一樣走 tz_convert('UTC') 的流程
+    # 回傳 {symbol: 配息 Series}，下載失敗或不在結果中的代碼不會出現在 dict 裡
+    # 本身不快取，由 lookup_batch_dividends 以 (symbol, as_of) 逐檔存放結果
+    df = yf.download(
+        tickers=' '.join(symbols),
+        start=start,
+        actions=True,
+        group_by='ticker',
+        threads=True,
+        progress=False,
+        ignore_tz=False,
+    )
+    
+    batch = {}
+    if df is None or df.empty:
+        return batch
     
-    # 設定基準時間為 UTC
+    for symbol in symbols:
+        if isinstance(df.columns, pd.MultiIndex):
+            if symbol not in df.columns.get_level_values(0):
+                continue
+            frame = df[symbol]
+        elif len(symbols) == 1:
+            frame = df
+        else:
+            continue
+        
+        # 整欄都是 NaN 代表該代碼下載失敗，交給逐檔查詢處理
+        if 'Dividends' not in frame.columns or frame['Close'].isna().all():
+            continue
+        
+        divs = frame['Dividends'].dropna()
+        divs = divs[divs != 0]
+        
+        # 區間內沒有配息時，無法分辨是「近期沒配」還是「從未配息」，
+        # 交給逐檔查詢完整歷史，維持「查無配息紀錄」只在完全沒有紀錄時出現
+        if not divs.empty:
+            batch[symbol] = divs
+    return batch
+
+
+@st.cache_resource(show_spinner=False)
+def _batch_store():
+    # 批次下載結果的共用快取：{(symbol, as_of): 配息 Series 或 None}
+    # None 代表該代碼不在批次結果中，之後直接走逐檔查詢 (由 fetch_dividends 的快取負責)
+    # 所有 session 共用同一份資料，取出的 Series 不可修改
+    return {}, threading.Lock()
+
+
+def lookup_batch_dividends(symbols: tuple, as_of: str, start: str) -> dict:
+    # 先查 (symbol, as_of) 快取，只把當天還沒查過的代碼送去批次下載
+    store, lock = _batch_store()
+    with lock:
+        found = {symbol: store[(symbol, as_of)] for symbol in symbols if (symbol, as_of) in store}
+    
+    to_download = tuple(symbol for symbol in symbols if symbol not in found)
+    if not to_download:
+        return found
+    
+    try:
+        downloaded = fetch_dividends_batch(to_download, start)
+    except Exception:
+        # 批次下載整個失敗時不寫入快取，這次全部改走逐檔查詢
+        found.update(dict.fromkeys(to_download))
+        return found
+    
+    with lock:
+        # 換日後清掉前一天的結果，避免快取無限成長
+        for key in [key for key in store if key[1] != as_of]:
+            del store[key]
+        for symbol in to_download:
+            store[(symbol, as_of)] = found[symbol] = downloaded.get(symbol)
+    return found
+
+
+@st.cache_data(ttl=60 * 60, show_spinner=False)
+def _window():
+    # 過去 12 個月的計算區間 (基準時間為 UTC)，每小時才重新計算一次
     end_date = pd.Timestamp.now(tz='UTC')
-    start_date = end_date - pd.DateOffset(months=12)
+    return end_date - pd.DateOffset(months=12), end_date
+
+
+def _fetch_divs(symbol, shares, as_of):
+    # 在背景執行緒中執行，只做網路請求，不呼叫任何 st.* 元件
+    try:
+        return symbol, shares, fetch_dividends(symbol, as_of)
+    except Exception as e:
+        return symbol, shares, e
+
+
+def calculate_portfolio_dividends(portfolio):
+    all_payouts = []
+    
+    start_date, end_date = _window()
+    start_naive = start_date.tz_localize(None)
     
     progress_bar = st.progress(0)
     status_text = st.empty()
     
-    for idx, item in enumerate(portfolio_list):
-        symbol = item['symbol']
-        shares = item['shares']
-        
-        status_text.text(f"正在處理: {symbol} ...")
-        
+    as_of = end_date.strftime('%Y-%m-%d')
+    
+    # 先以批次 API 抓取當天尚未快取的代碼
+    status_text.text("正在下載配息資料 ...")
+    holdings = list(zip(portfolio['symbol'], portfolio['shares']))
+    # 起始日多抓一天，確保涵蓋 12 個月區間的邊界，實際區間由下方的篩選決定
+    batch_start = (start_date - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    batch = lookup_batch_dividends(tuple(portfolio['symbol']), as_of, batch_start)
+    
+    results = [(symbol, shares, batch[symbol]) for symbol, shares in holdings if batch.get(symbol) is not None]
+    missing = [(symbol, shares) for symbol, shares in holdings if batch.get(symbol) is None]
+    
+    # 批次結果中缺少的代碼，才改用多執行緒逐檔查詢
+    # 工作執行緒需掛上 ScriptRunContext，st.cache_data 才能正常運作
+    if missing:
+        with ThreadPoolExecutor(
+            max_workers=min(16, len(missing)),
+            initializer=add_script_run_ctx,
+            initargs=(None, get_script_run_ctx()),
+        ) as executor:
+            futures = [executor.submit(_fetch_divs, symbol, shares, as_of) for symbol, shares in missing]
+            
+            # 進度條在主執行緒中更新，每次執行最多更新約 10 次以減少前端訊息
+            update_every = -(-len(missing) // 10)  # 無條件進位，確保最多約 10 次
+            for n, future in enumerate(as_completed(futures)):
+                symbol, shares, divs = future.result()
+                results.append((symbol, shares, divs))
+                if n % update_every == 0 or n == len(missing) - 1:
+                    status_text.text(f"正在處理: {symbol} ...")
+                    progress_bar.progress((n + 1) / len(missing))
+    
+    # st.error / st.toast 皆在主執行緒中處理
+    for symbol, shares, divs in results:
         try:
-            stock = yf.Ticker(symbol)
-            divs = stock.dividends
+            if isinstance(divs, Exception):
+                raise divs
             
             if not divs.empty:
-                # 統一處理 yfinance 回傳的時間索引
-                divs_index = divs.index
-                if divs_index.tz is None:
-                    divs_index = divs_index.tz_localize('UTC')
-                else:
-                    divs_index = divs_index.tz_convert('UTC')
+                # yfinance 回傳的時間索引可能有或沒有時區，改用對應型別的起始時間比較，
+                # 不重設 divs.index (避免複製整個 Series，也不修改快取中的資料)
+                idx = divs.index
+                start_cmp = start_date if idx.tz is not None else start_naive
+                recent_divs = divs[idx >= start_cmp]
                 
-                divs.index = divs_index
-                recent_divs = divs[divs.index >= start_date]
+                # 月份與日期沿用原本以 UTC 為準的算法：只轉換篩選後的小索引，
+                # 不改動 divs 本身 (交易所當地時間會讓 .TW 的日期與月份偏移)
+                idx = recent_divs.index
+                idx = idx.tz_localize('UTC') if idx.tz is None else idx.tz_convert('UTC')
                 
-                for date, amount in recent_divs.items():
-                    month = date.month
-                    payout = amount * shares
-                    
-                    all_payouts.append({
-                        "Symbol": symbol,
-                        "Month": month,
-                        "Amount": payout,
-                        "PayDate": date.strftime('%Y-%m-%d')
-                    })
+                # 整批建立該檔股票的配息明細，避免逐筆建立 dict；
+                # 月份一次從 DatetimeIndex 取出成 int 陣列，不逐筆 box 成 Timestamp
+                months_arr = idx.month.to_numpy()
+                amounts_arr = recent_divs.to_numpy() * shares
+                pay_dates = idx.strftime('%Y-%m-%d').to_numpy()
+                all_payouts.append(pd.DataFrame({
+                    "Symbol": symbol,
+                    "Month": months_arr,
+                    "Amount": amounts_arr,
+                    "PayDate": pay_dates
+                }))
             else:
                 st.toast(f"⚠️ {symbol} 查無配息紀錄")
                 
         except Exception as e:
             st.error(f"讀取 {symbol} 失敗: {e}")
-            
-        progress_bar.progress((idx + 1) / len(portfolio_list))
         
     status_text.empty()
     progress_bar.empty()
-    return pd.DataFrame(all_payouts)
+    
+    if not all_payouts:
+        return pd.DataFrame(columns=["Symbol", "Month", "Amount", "PayDate"])
+    df_result = pd.concat(all_payouts, ignore_index=True)
+    # 配息金額不需要 float64 的精度，改用 float32 減少後續處理的資料量
+    df_result['Amount'] = df_result['Amount'].astype('float32')
+    return df_result
 
 # --- 4. 主畫面顯示 ---
 st.title("📅 每月領息金額 (NTD)")
 st.caption("計算邏輯：基於**過去 12 個月**的實際配息紀錄，推算若持有相同股數，各月份可領取的金額。")
 
-if not st.session_state.portfolio:
+if not st.session_state.portfolio['symbol']:
     st.warning("👈 請先在左側側邊欄新增股票代碼！")
 else:
-    if st.button("開始計算分析 🚀", use_container_width=True):
+    # 編輯器與 session_state 不一致時不允許計算，避免用到使用者看不到的清單
+    if editor_pending:
+        st.warning("👈 側邊欄的清單還有尚未套用的修改，請先完成或修正後再計算。")
+    
+    if st.button("開始計算分析 🚀", use_container_width=True, disabled=editor_pending):
         
         df_result = calculate_portfolio_dividends(st.session_state.portfolio)
         
@@ -162,26 +359,30 @@ else:
             # --- 資料處理：轉置成 月份表 ---
             months_range = list(range(1, 13))
             
-            pivot_df = df_result.pivot_table(
-                index='Symbol', 
-                columns='Month', 
-                values='Amount', 
-                aggfunc='sum',
-                fill_value=0
-            )
+            # Symbol 轉成 categorical：類別已排序，codes 即為每列對應的股票索引，不必再雜湊字串
+            df_result['Symbol'] = df_result['Symbol'].astype('category')
             
-            for m in months_range:
-                if m not in pivot_df.columns:
-                    pivot_df[m] = 0
+            # 結果固定是「股票數 x 12 個月」的矩陣，直接用 numpy 累加，不經過 pivot
+            uniq_syms = df_result['Symbol'].cat.categories
+            sym_idx = df_result['Symbol'].cat.codes.to_numpy()
+            months_arr = df_result['Month'].to_numpy(dtype=int)
+            amounts_arr = df_result['Amount'].to_numpy()
             
-            pivot_df = pivot_df[months_range]
+            # 累加用 float64，避免加總時的精度誤差
+            mat = np.zeros((uniq_syms.size, 12))
+            np.add.at(mat, (sym_idx, months_arr - 1), amounts_arr)
+            
+            pivot_df = pd.DataFrame(
+                mat,
+                index=pd.Index(uniq_syms, dtype=object, name='Symbol'),
+                columns=months_range
+            )
             pivot_df['Total'] = pivot_df.sum(axis=1)
             monthly_totals = pivot_df.sum(axis=0)
             
             # --- 表格加總行 ---
-            monthly_totals_row = pd.DataFrame(monthly_totals).T
-            monthly_totals_row.index = ['每月總和']
-            display_pivot_df = pd.concat([pivot_df, monthly_totals_row])
+            display_pivot_df = pivot_df.copy()
+            display_pivot_df.loc['每月總和'] = monthly_totals
             
             # --- 視覺化呈現 ---
             
@@ -217,17 +418,31 @@ else:
             # 3. 詳細表格 (熱點圖)
             st.subheader("📋 各股每月配息明細表")
             
-            # 定義 Styler 函數來強調最後一列 (每月總和)
-            def highlight_total_row(row):
-                if row.name == '每月總和':
-                    return ['font-weight: bold; background-color: #dee2e6'] * len(row)
-                return [''] * len(row)
+            # 定義 Styler 函數：一次算出所有儲存格的樣式
+            # (整張表的綠色漸層熱點圖，並強調最後一列每月總和)
+            def style_all(df):
+                values = df.to_numpy(dtype=np.float32)
+                norm = Normalize(vmin=np.nanmin(values), vmax=np.nanmax(values))
+                rgb = colormaps['Greens'](norm(values))[..., :3]
+                
+                # 依背景亮度決定文字顏色，規則與 background_gradient 相同
+                linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+                luminance = linear @ np.array([0.2126, 0.7152, 0.0722])
+                text_colors = np.where(luminance < 0.408, '#f1f1f1', '#000000')
+                
+                rgb_int = np.rint(rgb * 255).astype(int).reshape(-1, 3)
+                css = np.array([
+                    f"background-color: #{r:02x}{g:02x}{b:02x}; color: {color};"
+                    for (r, g, b), color in zip(rgb_int, text_colors.ravel())
+                ], dtype=object).reshape(values.shape)
+                
+                css[df.index == '每月總和', :] = 'font-weight: bold; background-color: #dee2e6'
+                return pd.DataFrame(css, index=df.index, columns=df.columns)
             
             # 應用樣式
             styled_df = display_pivot_df.style \
                 .format("{:,.0f}") \
-                .background_gradient(cmap="Greens", axis=None) \
-                .apply(highlight_total_row, axis=1)
+                .apply(style_all, axis=None)
                 
             st.dataframe(
                 styled_df, 